@@ -0,0 +1,114 @@
+"""
+encode the training set with the codec once and save the codes to disk,
+so training doesn't have to run the codec forward pass every step.
+
+usage:
+    python scripts/exp/precompute_codes.py --args.load conf/vampnet.yml \
+        --codes_path codes/train.npy --n_items 100000
+    python scripts/exp/train.py --args.load conf/vampnet.yml \
+        --codes_path codes/train.npy
+
+item i of the codes file is the encoding of item i of the train dataset.
+this only holds for deterministic transforms (the default VolumeNorm + RescaleAudio
+is), since random augmentations would get frozen into the codes.
+"""
+import logging
+from pathlib import Path
+
+import argbind
+import numpy as np
+import torch
+import tqdm
+
+# reuse the dataset + transform setup from train.py,
+# so the codes match what the train loop would encode
+from train import DAC, Accelerator, apply_transform, build_collate, build_datasets
+from vampnet.util import prepare_batch
+
+
+def write_codes(
+    codec,
+    train_data,
+    codes_path: str,
+    n_items: int = None,
+    batch_size: int = 32,
+    num_workers: int = 10,
+    device: str = "cpu",
+):
+    """
+    encodes the first n_items of train_data (all of them by default)
+    and writes the codes to an int16 (n_items, n_codebooks, time) .npy
+    file at codes_path, which CodesDataset reads.
+    """
+    n_items = len(train_data) if n_items is None else min(n_items, len(train_data))
+    subset = torch.utils.data.Subset(train_data, range(n_items))
+    dataloader = torch.utils.data.DataLoader(
+        subset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=build_collate(train_data),
+        shuffle=False,
+        pin_memory=True,
+    )
+
+    codes = None
+    idx = 0
+    for batch in tqdm.tqdm(dataloader, desc="encoding"):
+        batch = prepare_batch(batch, device)
+        signal = apply_transform(train_data.transform, batch)
+        with torch.inference_mode():
+            z = codec.encode(signal.samples, signal.sample_rate)["codes"]
+
+        if codes is None:
+            # the codebook size is 1024, so the codes fit in int16
+            assert codec.quantizer.quantizers[0].codebook_size <= 2**15
+            Path(codes_path).parent.mkdir(parents=True, exist_ok=True)
+            codes = np.lib.format.open_memmap(
+                codes_path, mode="w+", dtype=np.int16, shape=(n_items, *z.shape[1:])
+            )
+
+        codes[idx : idx + z.shape[0]] = z.cpu().numpy().astype(np.int16)
+        idx += z.shape[0]
+
+    codes.flush()
+    logging.info(
+        "saved %d items of shape %s to %s", n_items, tuple(codes.shape[1:]), codes_path
+    )
+    return codes_path
+
+
+@argbind.bind(without_prefix=True)
+def precompute(
+    args,
+    accel,
+    codes_path: str = None,
+    n_items: int = None,
+    encode_batch_size: int = 32,
+    encode_num_workers: int = 10,
+):
+    assert codes_path is not None, "codes_path is required"
+    assert args.get("codec_ckpt") is not None, "codec_ckpt is required"
+
+    codec = DAC.load(args["codec_ckpt"], map_location="cpu")
+    codec.eval()
+    codec.requires_grad_(False)
+    codec.to(accel.device)
+
+    train_data, _ = build_datasets(args, codec.sample_rate)
+    return write_codes(
+        codec,
+        train_data,
+        codes_path,
+        n_items=n_items,
+        batch_size=encode_batch_size,
+        num_workers=encode_num_workers,
+        device=accel.device,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = argbind.parse_args()
+    with argbind.scope(args):
+        with Accelerator() as accel:
+            precompute(args, accel)
@@ -1,3 +1,7 @@
+import contextlib
+import copy
+import csv
+import hashlib
 import os
 import sys
 import warnings
@@ -7,18 +11,20 @@ from dataclasses import dataclass
 
 import argbind
 import audiotools as at
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+import torch.nn.functional as F
 from audiotools import AudioSignal
 from audiotools.data import transforms as tfm
-from einops import rearrange
 from rich import pretty
 from rich.traceback import install
 from torch.utils.tensorboard import SummaryWriter
 
 import vampnet
 from vampnet.modules.transformer import VampNet
-from vampnet.util import codebook_unflatten, codebook_flatten
+from vampnet.util import codebook_unflatten, codebook_flatten, prepare_batch
 from vampnet import mask as pmask
 # from dac.model.dac import DAC
 from lac.model.lac import LAC as DAC
@@ -30,14 +36,23 @@ from audiotools.ml.decorators import (
 import loralib as lora
 
 import torch._dynamo
-torch._dynamo.config.verbose=True
+# debugging aids, both off by default since they slow down every step.
+# VAMPNET_DYNAMO_VERBOSE=1 for full dynamo tracebacks,
+# VAMPNET_DETECT_ANOMALY=1 to find the op producing a nan in backward.
+torch._dynamo.config.verbose = bool(int(os.getenv("VAMPNET_DYNAMO_VERBOSE", 0)))
+torch.autograd.set_detect_anomaly(bool(int(os.getenv("VAMPNET_DETECT_ANOMALY", 0))))
 
 
 # Enable cudnn autotuner to speed up training
+# (vampnet and the codec only use 1d convs, so there's no channels_last
+# layout to opt into here. the autotuner picks the conv algorithms.)
 # (can be altered by the funcs.seed function)
 torch.backends.cudnn.benchmark = bool(int(os.getenv("CUDNN_BENCHMARK", 1)))
 # Uncomment to trade memory for speed.
 
+# Compile the model with inductor (set VAMPNET_COMPILE=0 to debug in eager mode)
+COMPILE = bool(int(os.getenv("VAMPNET_COMPILE", 1)))
+
 # Install to make things look nice
 warnings.filterwarnings("ignore", category=UserWarning)
 pretty.install()
@@ -74,25 +89,151 @@ def build_transform():
         # tfm.PitchShift(),
         tfm.RescaleAudio(),
     )
+    # an identity pipeline can't touch the batch, so there's no need to copy it
+    transform.needs_clone = not _is_identity(transform)
     return transform
 
 
-@torch.no_grad()
+def _is_identity(transform):
+    if isinstance(transform, tfm.Compose):
+        return all(_is_identity(t) for t in transform.transforms)
+    return isinstance(transform, tfm.Identity)
+
+
+def _needs_loudness(transform):
+    if isinstance(transform, tfm.Compose):
+        return len(transform.transforms) > 0 and _needs_loudness(transform.transforms[0])
+    return isinstance(transform, tfm.VolumeNorm)
+
+
+class LoudnessCollate:
+    """
+    wraps a collate fn to measure the loudness of each signal in the
+    dataloader workers and keep it on the batched signal (AudioSignal.batch
+    drops it). a leading VolumeNorm then reads the cached loudness instead of
+    measuring the whole batch on the device every step.
+    """
+
+    def __init__(self, collate):
+        self.collate = collate
+
+    def __call__(self, list_of_dicts):
+        loudness = []
+        for item in list_of_dicts:
+            sig = item["signal"]
+            # the loader's salient excerpt check caches the loudness from
+            # before the signal was made mono + resampled, so measure again
+            sig._loudness = None
+            loudness.append(sig.loudness())
+        batch = self.collate(list_of_dicts)
+        batch["signal"]._loudness = torch.cat(loudness)
+        return batch
+
+
+def build_collate(dataset):
+    if _needs_loudness(getattr(dataset, "transform", None)):
+        return LoudnessCollate(dataset.collate)
+    return dataset.collate
+
+
+@torch.inference_mode()
 def apply_transform(transform_fn, batch):
     sig: AudioSignal = batch["signal"]
     kwargs = batch["transform_args"]
 
-    sig: AudioSignal = transform_fn(sig.clone(), **kwargs)
+    if getattr(transform_fn, "needs_clone", True):
+        # only the audio is written to by the transforms, so we copy the
+        # tensor instead of the whole signal (stft data, metadata, etc.)
+        sig = copy.copy(sig)
+        sig.audio_data = sig.audio_data.clone()
+
+    sig: AudioSignal = transform_fn(sig, **kwargs)
     return sig
 
 
-def build_datasets(args, sample_rate: int):
-    with argbind.scope(args, "train"):
-        train_data = AudioDataset(
-            AudioLoader(), sample_rate, transform=build_transform()
-        )
-    with argbind.scope(args, "val"):
-        val_data = AudioDataset(AudioLoader(), sample_rate, transform=build_transform())
+class CodesDataset(torch.utils.data.Dataset):
+    """
+    codec codes precomputed by scripts/exp/precompute_codes.py, so the
+    train loop can skip the transform + codec forward pass.
+    item i is the encoding of item i of the audio dataset,
+    which is stable since the train transform is deterministic per index.
+    indices past the end of the file wrap around.
+    """
+
+    def __init__(self, path: str, n_examples: int = None):
+        self.path = path
+        # opened lazily, so each dataloader worker gets its own memmap
+        self.codes = None
+        self.n_items = np.load(path, mmap_mode="r").shape[0]
+        self.n_examples = self.n_items if n_examples is None else n_examples
+
+    def __len__(self):
+        return self.n_examples
+
+    def __getitem__(self, idx):
+        if self.codes is None:
+            self.codes = np.load(self.path, mmap_mode="r")
+        codes = self.codes[idx % self.n_items].astype(np.int32)
+        return {"codes": torch.from_numpy(codes), "idx": idx}
+
+    @staticmethod
+    def collate(list_of_dicts):
+        return torch.utils.data.default_collate(list_of_dicts)
+
+
+def cache_sources(sources: list, cache_dir: str) -> list:
+    """
+    replaces each audio folder in sources with a csv manifest of its files,
+    so we only glob the (possibly huge) folder the first time.
+    the manifests are written by rank 0, delete them to pick up new files.
+    """
+    cache_dir = Path(cache_dir)
+    is_main = not dist.is_initialized() or dist.get_rank() == 0
+
+    cached = []
+    for source in sources:
+        source = str(source)
+        if source.endswith(".csv"):
+            cached.append(source)
+            continue
+        key = hashlib.md5(source.encode()).hexdigest()[:8]
+        manifest = cache_dir / f"{Path(source).name}-{key}.csv"
+        if is_main and not manifest.exists():
+            manifest.parent.mkdir(parents=True, exist_ok=True)
+            files = at.util.find_audio(source)
+            tmp = manifest.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                writer = csv.writer(f)
+                writer.writerow(["path"])
+                writer.writerows([str(x)] for x in files)
+            os.replace(tmp, manifest)
+        cached.append(str(manifest))
+
+    if dist.is_initialized():
+        dist.barrier()
+    return cached
+
+
+def _scoped_sources(args, scope: str):
+    return args.get(f"{scope}/AudioLoader.sources", args.get("AudioLoader.sources"))
+
+
+def build_datasets(
+    args, sample_rate: int, codes_path: str = None, source_cache_dir: str = None
+):
+    data = {}
+    for scope in ("train", "val"):
+        loader_kwargs = {}
+        if source_cache_dir is not None:
+            sources = _scoped_sources(args, scope)
+            loader_kwargs["sources"] = cache_sources(sources, source_cache_dir)
+        with argbind.scope(args, scope):
+            data[scope] = AudioDataset(
+                AudioLoader(**loader_kwargs), sample_rate, transform=build_transform()
+            )
+    train_data, val_data = data["train"], data["val"]
+    if codes_path is not None:
+        train_data = CodesDataset(codes_path, n_examples=len(train_data))
     return train_data, val_data
 
 
@@ -109,75 +250,245 @@ def num_params_hook(o, p):
 
 
 def add_num_params_repr_hook(model):
-    import numpy as np
+    from collections import defaultdict
     from functools import partial
 
+    # walk the params once, crediting each one to every module above it
+    # (instead of re-walking m.parameters() for every submodule)
+    counts = defaultdict(int)
+    for name, param in model.named_parameters():
+        parts = name.split(".")[:-1]
+        for i in range(len(parts) + 1):
+            counts[".".join(parts[:i])] += param.numel()
+
     for n, m in model.named_modules():
         o = m.extra_repr()
-        p = sum([np.prod(p.size()) for p in m.parameters()])
-
-        setattr(m, "extra_repr", partial(num_params_hook, o=o, p=p))
-
-
-def accuracy(
-    preds: torch.Tensor,
-    target: torch.Tensor,
-    top_k: int = 1,
-    ignore_index: Optional[int] = None,
-) -> torch.Tensor:
-    # Flatten the predictions and targets to be of shape (batch_size * sequence_length, n_class)
-    preds = rearrange(preds, "b p s -> (b s) p")
-    target = rearrange(target, "b s -> (b s)")
+        setattr(m, "extra_repr", partial(num_params_hook, o=o, p=counts[n]))
+
+
+def encode(state, signal: AudioSignal, n_codebooks: int) -> torch.Tensor:
+    """
+    encodes a signal to codes with the codec, under autocast if a
+    codec_dtype was given to load().
+    the codec weights stay in fp32, since vampnet also reads the codebooks
+    for its embeddings. (check that the codes still match fp32 before
+    training with this, the nearest codebook search runs in low precision too.)
+    """
+    ctx = contextlib.nullcontext()
+    if state.codec_dtype is not None:
+        ctx = torch.autocast(
+            device_type=signal.samples.device.type, dtype=state.codec_dtype
+        )
+    with ctx:
+        z = state.codec.encode(signal.samples, signal.sample_rate)["codes"]
+    # the codes index a 1024 entry codebook, no need for int64.
+    return z[:, :n_codebooks, :].int()
+
+
+def model_step(model, z_mask_latent):
+    # with compile_mode="reduce-overhead" the model runs as cuda graphs, whose
+    # outputs get overwritten by the next replay. marking every call as a new
+    # step tells torch we're done with the previous outputs.
+    if COMPILE:
+        torch.compiler.cudagraph_mark_step_begin()
+    return model(z_mask_latent)
+
+
+def _build_target(z, mask, n_conditioning_codebooks: int):
+    """
+    flattens the targets + mask of the non-conditioning codebooks, and
+    replaces the targets with the ignore index for unmasked tokens.
+    returns (target, flat_mask, t_masked), with flat_mask as a bool tensor.
+    (only t_masked is widened to int64, since that's what the loss wants)
+    """
+    target = codebook_flatten(z[:, n_conditioning_codebooks:, :])
+    flat_mask = codebook_flatten(mask[:, n_conditioning_codebooks:, :]).bool()
+    t_masked = torch.where(flat_mask, target, IGNORE_INDEX).long()
+    return target, flat_mask, t_masked
+
+
+# these are all elementwise + reshapes, so inductor fuses them into one pass
+build_target = (
+    torch.compile(_build_target, dynamic=False) if COMPILE else _build_target
+)
 
-    # return torchmetrics.functional.accuracy(preds, target, task='multiclass', top_k=topk, num_classes=preds.shape[-1], ignore_index=ignore_index)
-    if ignore_index is not None:
-        # Create a mask for the ignored index
-        mask = target != ignore_index
-        # Apply the mask to the target and predictions
-        preds = preds[mask]
-        target = target[mask]
 
-    # Get the top-k predicted classes and their indices
-    _, pred_indices = torch.topk(preds, k=top_k, dim=-1)
+def masked_loss(criterion: nn.CrossEntropyLoss, z_hat, t_masked, n_masked):
+    """
+    same as criterion(z_hat, t_masked), but sums the loss and divides by
+    n_masked, the number of masked tokens (which we already have from the mask).
+    with grad accumulation, n_masked is the count over all the micro batches.
+    """
+    loss = F.cross_entropy(
+        z_hat,
+        t_masked,
+        ignore_index=criterion.ignore_index,
+        reduction="sum",
+        label_smoothing=criterion.label_smoothing,
+    )
+    return loss / n_masked.clamp(min=1)
 
-    # Determine if the true target is in the top-k predicted classes
-    correct = torch.sum(torch.eq(pred_indices, target.unsqueeze(1)), dim=1)
 
-    # Calculate the accuracy
-    accuracy = torch.mean(correct.float())
+def mask_batch(vn, z, r):
+    """
+    masks z for a train/val step, and builds the flat targets + mask once
+    for both the loss and the metrics. returns (z_mask, target, flat_mask, t_masked).
+    (skips apply_mask's checks that the mask is binary, which sync with the
+    host every step. pmask.random already only returns 0s and 1s.)
+    """
+    mask = pmask.random(z, r)
+    mask = pmask.codebook_unmask(mask, vn.n_conditioning_codebooks)
+    z_mask = torch.where(mask.bool(), vn.mask_token, z)
+    return (z_mask, *build_target(z, mask, vn.n_conditioning_codebooks))
 
-    return accuracy
 
 def _metrics(z_hat, r, target, flat_mask, output):
-    for r_range in [(0, 0.5), (0.5, 1.0)]:
-        unmasked_target = target.masked_fill(flat_mask.bool(), IGNORE_INDEX)
-        masked_target = target.masked_fill(~flat_mask.bool(), IGNORE_INDEX)
-
-        assert target.shape[0] == r.shape[0]
-        # grab the indices of the r values that are in the range
-        r_idx = (r >= r_range[0]) & (r < r_range[1])
-
-        # grab the target and z_hat values that are in the range
-        r_unmasked_target = unmasked_target[r_idx]
-        r_masked_target = masked_target[r_idx]
-        r_z_hat = z_hat[r_idx]
-
-        for topk in (1, 25):
-            s, e = r_range
+    # one topk over the whole batch. top1 is the first column of the top25 hits,
+    # and each (r range, masked/unmasked) accuracy is just a different subset
+    # of the same hits.
+    flat_mask = flat_mask.reshape(-1)
+    preds = z_hat.transpose(1, 2).reshape(-1, z_hat.shape[1])
+    _, top25 = preds.topk(25, dim=-1)
+    correct = top25 == target.reshape(-1, 1)
+    hits = {1: correct[:, 0], 25: correct.any(dim=-1)}
+
+    assert target.shape[0] == r.shape[0]
+    r_ranges = [(0, 0.5), (0.5, 1.0)]
+    # bucket id of each example's r, repeated for each of its tokens
+    bounds = torch.tensor([e for _, e in r_ranges[:-1]], device=r.device)
+    bucket = torch.bucketize(r, bounds, right=True)
+    bucket = bucket.repeat_interleave(target.shape[-1])
+
+    # sum the hits and valid tokens of every bucket in a single index_add
+    valid = {"unmasked": ~flat_mask, "masked": flat_mask}
+    cols = [hit & v for hit in hits.values() for v in valid.values()]
+    cols += list(valid.values())
+    sums = torch.zeros(len(r_ranges), len(cols), device=r.device)
+    sums.index_add_(0, bucket, torch.stack(cols, dim=-1).float())
+    n_valid = sums[:, -len(valid):].clamp(min=1)
+
+    for i, (s, e) in enumerate(r_ranges):
+        for k, topk in enumerate(hits):
             tag = f"accuracy-{s}-{e}/top{topk}"
+            for j, name in enumerate(valid):
+                col = k * len(valid) + j
+                output[f"{tag}/{name}"] = sums[i, col] / n_valid[i, j]
+
+
+def _collect_scalars(output: dict, accel: Accelerator) -> dict:
+    # the tracker does an allreduce + .item() per metric. do it once for all of
+    # them instead: stack, average across ranks, and copy to the host together.
+    keys = [k for k, v in output.items() if torch.is_tensor(v) and v.numel() == 1]
+    if len(keys) == 0:
+        return output
+
+    values = torch.stack([output[k].detach().float().reshape(()) for k in keys])
+    if accel.use_ddp:
+        torch.distributed.all_reduce(values, op=torch.distributed.ReduceOp.AVG)
+    output.update(zip(keys, values.tolist()))
+    return output
 
-            output[f"{tag}/unmasked"] = accuracy(
-                preds=r_z_hat,
-                target=r_unmasked_target,
-                ignore_index=IGNORE_INDEX,
-                top_k=topk,
-            )
-            output[f"{tag}/masked"] = accuracy(
-                preds=r_z_hat,
-                target=r_masked_target,
-                ignore_index=IGNORE_INDEX,
-                top_k=topk,
-            )
+
+class CUDAPrefetcher:
+    """
+    wraps a dataloader so that the host->device copy of the next batch
+    runs on a side stream while the current batch is being computed on.
+    falls back to a regular (blocking) copy when cuda isn't available.
+    """
+
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = device
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    def _preload(self, batch):
+        if self.stream is None:
+            return prepare_batch(batch, self.device)
+        with torch.cuda.stream(self.stream):
+            return prepare_batch(batch, self.device)
+
+    def _wait(self, batch):
+        if self.stream is None:
+            return batch
+        stream = torch.cuda.current_stream()
+        stream.wait_stream(self.stream)
+        # tell the caching allocator these tensors are now used by the compute stream
+        for val in at.util.flatten(batch).values():
+            if isinstance(val, AudioSignal):
+                val = [val.audio_data, val._loudness, val.stft_data]
+            for t in (val if isinstance(val, list) else [val]):
+                if torch.is_tensor(t) and t.is_cuda:
+                    t.record_stream(stream)
+        return batch
+
+    def __iter__(self):
+        batches = iter(self.dataloader)
+        try:
+            next_batch = self._preload(next(batches))
+        except StopIteration:
+            return
+        for batch in batches:
+            current = self._wait(next_batch)
+            next_batch = self._preload(batch)
+            yield current
+        yield self._wait(next_batch)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+
+class SobolBuffer:
+    """
+    draws from a SobolEngine a block at a time into pinned host memory,
+    and hands out slices of it already copied to the device (non blocking).
+    the points come out in the same order as calling engine.draw(n) every step.
+    """
+
+    def __init__(self, engine, device, block_size: int = 8192):
+        self.engine = engine
+        self.device = device
+        self.block_size = block_size
+        self.buf = None
+        self.i = 0
+
+    def _refill(self, n):
+        rest = self.buf[self.i :] if self.buf is not None else None
+        block = self.engine.draw(max(n, self.block_size))
+        if rest is not None and len(rest) > 0:
+            block = torch.cat([rest, block])
+        # fresh pinned memory each time, so we never overwrite a block
+        # that still has a copy in flight
+        self.buf = block.pin_memory() if torch.cuda.is_available() else block
+        self.i = 0
+
+    def draw(self, n: int) -> torch.Tensor:
+        if self.buf is None or self.i + n > len(self.buf):
+            self._refill(n)
+        out = self.buf[self.i : self.i + n]
+        self.i += n
+        return out.to(self.device, non_blocking=True)
+
+
+def _drop_stale_metrics(tracker: Tracker, label: str):
+    # the tracker logs (and shows) the last value of every key it has seen on
+    # every step. drop the accuracies from the last metric step, so they're
+    # only logged on steps that actually computed them.
+    values = tracker.metrics[label]["value"]
+    for k in [k for k in values if k.startswith("accuracy")]:
+        del values[k]
+
+
+def _grouped(batches, n: int):
+    """
+    yields lists of n consecutive batches, one list per optimizer step.
+    (a last, incomplete group is dropped, like drop_last)
+    """
+    group = []
+    for batch in batches:
+        group.append(batch)
+        if len(group) == n:
+            yield group
+            group = []
 
 
 @dataclass
@@ -189,119 +500,143 @@ class State:
     scheduler: NoamScheduler
     criterion: CrossEntropyLoss
     grad_clip_val: float
+    grad_acc_steps: int
+    metrics_freq: int
+    autocast_dtype: torch.dtype
+    codec_dtype: Optional[torch.dtype]
 
-    rng: torch.quasirandom.SobolEngine
+    rng: SobolBuffer
 
-    train_data: AudioDataset
+    train_data: AudioDataset # or CodesDataset
     val_data: AudioDataset
 
     tracker: Tracker
 
 
 @timer()
-def train_loop(state: State, batch: dict, accel: Accelerator):
-    state.model.train()
-    batch = at.util.prepare_batch(batch, accel.device)
-    signal = apply_transform(state.train_data.transform, batch)
-
+def train_loop(state: State, batches: list, accel: Accelerator):
+    # one optimizer step over grad_acc_steps loader batches (see _grouped).
+    # (the model is put in train mode once before the loop,
+    # and validate/save_samples switch it back when they're done)
+    # batches are already on the device (see CUDAPrefetcher)
     output = {}
     vn = accel.unwrap(state.model)
-    with accel.autocast():
-        with torch.inference_mode():
-            state.codec.to(accel.device)
-            z = state.codec.encode(signal.samples, signal.sample_rate)["codes"]
-            z = z[:, : vn.n_codebooks, :]
-
-        n_batch = z.shape[0]
-        r = state.rng.draw(n_batch)[:, 0].to(accel.device)
-
-        mask = pmask.random(z, r)
-        mask = pmask.codebook_unmask(mask, vn.n_conditioning_codebooks)
-        z_mask, mask = pmask.apply_mask(z, mask, vn.mask_token)
-        
-        z_mask_latent = vn.embedding.from_codes(z_mask, state.codec)
-
-        dtype = torch.bfloat16 if accel.amp else None
-        with accel.autocast(dtype=dtype):
-            z_hat = state.model(z_mask_latent)
-
-        target = codebook_flatten(
-            z[:, vn.n_conditioning_codebooks :, :],
-        )
-
-        flat_mask = codebook_flatten(
-            mask[:, vn.n_conditioning_codebooks :, :],
-        )
-
-        # replace target with ignore index for masked tokens
-        t_masked = target.masked_fill(~flat_mask.bool(), IGNORE_INDEX)
-        output["loss"] = state.criterion(z_hat, t_masked)
-
-        _metrics(
-            r=r,
-            z_hat=z_hat,
-            target=target,
-            flat_mask=flat_mask,
-            output=output,
+    log_metrics = state.tracker.step % state.metrics_freq == 0
+    if not log_metrics:
+        _drop_stale_metrics(state.tracker, "train")
+
+    # mask every micro batch up front, so we know how many tokens are masked
+    # across the whole step. each micro batch's summed loss is divided by that,
+    # and the accumulated grads match those of one big batch.
+    micro = []
+    for batch in batches:
+        if "codes" in batch:
+            # precomputed, see CodesDataset
+            z = batch["codes"][:, : vn.n_codebooks, :]
+        else:
+            signal = apply_transform(state.train_data.transform, batch)
+            with accel.autocast(dtype=state.autocast_dtype):
+                with torch.inference_mode():
+                    z = encode(state, signal, vn.n_codebooks)
+
+        r = state.rng.draw(z.shape[0])[:, 0]
+        micro.append((r, *mask_batch(vn, z, r)))
+    n_masked = torch.stack([m[3].sum() for m in micro]).sum()
+
+    # bf16 has the same range as fp32, so only fp16 needs the grad scaler
+    use_scaler = accel.amp and state.autocast_dtype == torch.float16
+
+    # under ddp, only the last micro step allreduces the grads,
+    # the rest accumulate locally.
+    output["loss"] = 0.0
+    for i, (r, z_mask, target, flat_mask, t_masked) in enumerate(micro):
+        last_micro = i == len(micro) - 1
+        sync = (
+            state.model.no_sync()
+            if accel.use_ddp and not last_micro
+            else contextlib.nullcontext()
         )
-
-    
-    accel.backward(output["loss"])
+        with sync:
+            with accel.autocast(dtype=state.autocast_dtype):
+                z_mask_latent = vn.embedding.from_codes(z_mask, state.codec)
+
+                z_hat = model_step(state.model, z_mask_latent)
+
+                loss = masked_loss(state.criterion, z_hat, t_masked, n_masked)
+
+                # (the accuracy metrics only look at the last micro batch,
+                # and only every metrics_freq steps)
+                if last_micro and log_metrics:
+                    _metrics(
+                        r=r,
+                        z_hat=z_hat,
+                        target=target,
+                        flat_mask=flat_mask,
+                        output=output,
+                    )
+
+            if use_scaler:
+                accel.backward(loss)
+            else:
+                loss.backward()
+        output["loss"] = output["loss"] + loss.detach()
+
+    if use_scaler:
+        accel.scaler.unscale_(state.optimizer)
 
     output["other/learning_rate"] = state.optimizer.param_groups[0]["lr"]
-    output["other/batch_size"] = z.shape[0]
+    output["other/batch_size"] = sum(m[0].shape[0] for m in micro)
 
-
-    accel.scaler.unscale_(state.optimizer)
+    # scaler.step skips its own unscale when unscale_ already ran, so the
+    # grads are only swept once here. foreach does the norm + scale in
+    # a handful of kernels instead of one per param.
     output["other/grad_norm"] = torch.nn.utils.clip_grad_norm_(
-        state.model.parameters(), state.grad_clip_val
+        state.model.parameters(), state.grad_clip_val, foreach=True
     )
 
-    accel.step(state.optimizer)
-    state.optimizer.zero_grad()
+    if use_scaler:
+        accel.step(state.optimizer)
+        accel.update()
+    else:
+        state.optimizer.step()
+    state.optimizer.zero_grad(set_to_none=True)
 
     state.scheduler.step()
-    accel.update()
-
 
+    output = _collect_scalars(output, accel)
     return {k: v for k, v in sorted(output.items())}
 
 
 @timer()
-@torch.no_grad()
 def val_loop(state: State, batch: dict, accel: Accelerator):
-    state.model.eval()
-    state.codec.eval()
-    batch = at.util.prepare_batch(batch, accel.device)
+    output = _val_step(state, batch, accel)
+    # hand the tracker python floats. it would otherwise all_reduce the
+    # outputs in place, which isn't allowed on inference tensors.
+    return _collect_scalars(output, accel)
+
+
+@torch.inference_mode()
+def _val_step(state: State, batch: dict, accel: Accelerator):
+    batch = prepare_batch(batch, accel.device)
     signal = apply_transform(state.val_data.transform, batch)
 
     vn = accel.unwrap(state.model)
-    z = state.codec.encode(signal.samples, signal.sample_rate)["codes"]
-    z = z[:, : vn.n_codebooks, :]
+    z = encode(state, signal, vn.n_codebooks)
 
     n_batch = z.shape[0]
-    r = state.rng.draw(n_batch)[:, 0].to(accel.device)
+    r = state.rng.draw(n_batch)[:, 0]
 
-    mask = pmask.random(z, r)
-    mask = pmask.codebook_unmask(mask, vn.n_conditioning_codebooks)
-    z_mask, mask = pmask.apply_mask(z, mask, vn.mask_token)
+    z_mask, target, flat_mask, t_masked = mask_batch(vn, z, r)
 
     z_mask_latent = vn.embedding.from_codes(z_mask, state.codec)
 
-    z_hat = state.model(z_mask_latent)
-
-    target = codebook_flatten(
-        z[:, vn.n_conditioning_codebooks :, :],
-    )
-
-    flat_mask = codebook_flatten(
-        mask[:, vn.n_conditioning_codebooks :, :]
-    )
+    with accel.autocast(dtype=state.autocast_dtype):
+        z_hat = model_step(state.model, z_mask_latent)
+    # compute the loss and metrics in full precision
+    z_hat = z_hat.float()
 
     output = {}
-    # replace target with ignore index for masked tokens
-    t_masked = target.masked_fill(~flat_mask.bool(), IGNORE_INDEX)
-    output["loss"] = state.criterion(z_hat, t_masked)
+    output["loss"] = masked_loss(state.criterion, z_hat, t_masked, flat_mask.sum())
 
     _metrics(
         r=r,
@@ -315,8 +650,11 @@ def val_loop(state: State, batch: dict, accel: Accelerator):
 
 
 def validate(state, val_dataloader, accel):
+    # switch modes once per validation instead of every val step
+    state.model.eval()
     for batch in val_dataloader:
         output = val_loop(state, batch, accel)
+    state.model.train()
     # Consolidate state dicts if using ZeroRedundancyOptimizer
     if hasattr(state.optimizer, "consolidate_state_dict"):
         state.optimizer.consolidate_state_dict()
@@ -363,16 +701,25 @@ def checkpoint(state, save_iters, save_path, fine_tune):
         )
 
 
+def _to_cpu(signal: AudioSignal) -> AudioSignal:
+    # a host copy of the whole batch. AudioSignal.cpu() would move the
+    # signal in place, which we don't want for the cached sample batch.
+    return AudioSignal(signal.audio_data.cpu(), signal.sample_rate)
+
+
 def save_sampled(state, z, writer):
     num_samples = z.shape[0]
 
+    # sample the whole batch in one go,
+    # instead of one example at a time
+    sampled = accel.unwrap(state.model).generate(
+        codec=state.codec,
+        time_steps=z.shape[-1],
+        start_tokens=z,
+    )
+    sampled = _to_cpu(sampled)
     for i in range(num_samples):
-        sampled = accel.unwrap(state.model).generate(
-            codec=state.codec,
-            time_steps=z.shape[-1],
-            start_tokens=z[i : i + 1],
-        )
-        sampled.cpu().write_audio_to_tb(
+        sampled[i].write_audio_to_tb(
             f"sampled/{i}",
             writer,
             step=state.tracker.step,
@@ -393,32 +740,30 @@ def save_imputation(state, z, val_idx, writer):
     imputed_noisy = vn.to_signal(z_mask, state.codec)
     imputed_true = vn.to_signal(z, state.codec)
 
-    imputed = []
-    for i in range(len(z)):
-        imputed.append(
-            vn.generate(
-                codec=state.codec,
-                time_steps=z.shape[-1],
-                start_tokens=z[i][None, ...],
-                mask=mask[i][None, ...],
-            )   
-        )   
-    imputed = AudioSignal.batch(imputed)
+    imputed = vn.generate(
+        codec=state.codec,
+        time_steps=z.shape[-1],
+        start_tokens=z,
+        mask=mask,
+    )
 
+    imputed_noisy = _to_cpu(imputed_noisy)
+    imputed = _to_cpu(imputed)
+    imputed_true = _to_cpu(imputed_true)
     for i in range(len(val_idx)):
-        imputed_noisy[i].cpu().write_audio_to_tb(
+        imputed_noisy[i].write_audio_to_tb(
             f"inpainted_prompt/{i}",
             writer,
             step=state.tracker.step,
             plot_fn=None,
         )
-        imputed[i].cpu().write_audio_to_tb(
+        imputed[i].write_audio_to_tb(
             f"inpainted_middle/{i}",
             writer,
             step=state.tracker.step,
             plot_fn=None,
         )
-        imputed_true[i].cpu().write_audio_to_tb(
+        imputed_true[i].write_audio_to_tb(
             f"reconstructed/{i}",
             writer,
             step=state.tracker.step,
@@ -426,19 +771,37 @@ def save_imputation(state, z, val_idx, writer):
         )
 
 
-@torch.no_grad()
-def save_samples(state: State, val_idx: int, writer: SummaryWriter):
+# the val_idx examples (and their transforms) are the same every time we
+# save samples, so the transformed signal is kept on the device after the
+# first call. keyed by the tuple of indices.
+_sample_batch_cache = {}
+
+
+@torch.inference_mode()
+def save_samples(
+    state: State, val_idx: int, writer: SummaryWriter, num_workers: int = 4
+):
+    # (the codec is frozen in eval mode for the whole run, see load)
     state.model.eval()
-    state.codec.eval()
     vn = accel.unwrap(state.model)
 
-    batch = [state.val_data[i] for i in val_idx]
-    batch = at.util.prepare_batch(state.val_data.collate(batch), accel.device)
-
-    signal = apply_transform(state.val_data.transform, batch)
+    key = tuple(val_idx)
+    if key not in _sample_batch_cache:
+        # load + decode the sample audio in parallel workers instead of
+        # one by one on the main process
+        loader = torch.utils.data.DataLoader(
+            torch.utils.data.Subset(state.val_data, val_idx),
+            batch_size=len(val_idx),
+            num_workers=min(num_workers, len(val_idx)),
+            collate_fn=build_collate(state.val_data),
+            pin_memory=True,
+        )
+        batch = prepare_batch(next(iter(loader)), accel.device)
+        _sample_batch_cache[key] = apply_transform(state.val_data.transform, batch)
+    signal = _sample_batch_cache[key]
 
-    z = state.codec.encode(signal.samples, signal.sample_rate)["codes"]
-    z = z[:, : vn.n_codebooks, :]
+    # generate + to_signal work on int64 codes, so widen them back here
+    z = encode(state, signal, vn.n_codebooks).long()
 
     r = torch.linspace(0.1, 0.95, len(val_idx)).to(accel.device)
 
@@ -449,7 +812,7 @@ def save_samples(state: State, val_idx: int, writer: SummaryWriter):
 
     z_mask_latent = vn.embedding.from_codes(z_mask, state.codec)
 
-    z_hat = state.model(z_mask_latent)
+    z_hat = model_step(state.model, z_mask_latent)
 
     z_pred = torch.softmax(z_hat, dim=1).argmax(dim=1)
     z_pred = codebook_unflatten(z_pred, n_c=vn.n_predict_codebooks)
@@ -459,15 +822,17 @@ def save_samples(state: State, val_idx: int, writer: SummaryWriter):
     reconstructed = vn.to_signal(z, state.codec)
     masked = vn.to_signal(z_mask.squeeze(1), state.codec)
 
+    # one device->host copy per batch instead of one per example
+    audio_dict = {
+        "original": _to_cpu(signal),
+        "masked": _to_cpu(masked),
+        "generated": _to_cpu(generated),
+        "reconstructed": _to_cpu(reconstructed),
+    }
+    r = r.tolist()
     for i in range(generated.batch_size):
-        audio_dict = {
-            "original": signal[i],
-            "masked": masked[i],
-            "generated": generated[i],
-            "reconstructed": reconstructed[i],
-        }
         for k, v in audio_dict.items():
-            v.cpu().write_audio_to_tb(
+            v[i].write_audio_to_tb(
                 f"onestep/_{i}.r={r[i]:0.2f}/{k}",
                 writer,
                 step=state.tracker.step,
@@ -476,7 +841,29 @@ def save_samples(state: State, val_idx: int, writer: SummaryWriter):
 
     save_sampled(state=state, z=z, writer=writer)
     save_imputation(state=state, z=z, val_idx=val_idx, writer=writer)
+    state.model.train()
+
+
+def build_optimizer(params, accel: at.ml.Accelerator):
+    params = list(params)
+    use_zero = accel.world_size > 1
+
+    def _make(**kwargs):
+        if use_zero:
+            from torch.distributed.optim import ZeroRedundancyOptimizer
+            optimizer = ZeroRedundancyOptimizer(params, AdamW, **kwargs)
+            print(f"OPTIMIZER LR is {optimizer.param_groups[0]['lr']}")
+            return optimizer
+        return AdamW(params, **kwargs)
 
+    # the fused kernel updates every param in one launch, but it
+    # needs cuda tensors and a recent torch. fall back to foreach otherwise.
+    if "cuda" in str(accel.device):
+        try:
+            return _make(fused=True)
+        except (TypeError, RuntimeError) as e:
+            print(f"fused AdamW unavailable ({e}), using foreach")
+    return _make(foreach=True)
 
 
 @argbind.bind(without_prefix=True)
@@ -489,18 +876,30 @@ def load(
     tag: str = "latest",
     fine_tune_checkpoint: Optional[str] = None,
     grad_clip_val: float = 5.0,
+    compile_mode: str = "max-autotune-no-cudagraphs",
+    autocast_dtype: str = "bfloat16",
+    ddp_bucket_cap_mb: int = 100,
+    codes_path: Optional[str] = None,
+    # accumulate the grads of this many batches per optimizer step
+    # (the effective batch size is batch_size * grad_acc_steps)
+    grad_acc_steps: int = 1,
+    codec_dtype: Optional[str] = None,
+    source_cache_dir: Optional[str] = None,
+    metrics_freq: int = 50,
 ) -> State:
     codec = DAC.load(args["codec_ckpt"], map_location="cpu")
     codec.eval()
+    # the codec is frozen and its sample rate is fixed for the run, so
+    # move it to the device once here instead of every train step.
+    codec.requires_grad_(False)
+    codec.to(accel.device)
 
     model, v_extra = None, {}
 
     if args["fine_tune"]:
         assert fine_tune_checkpoint is not None, "Must provide a fine-tune checkpoint"
-        model = torch.compile(
-            VampNet.load(location=Path(fine_tune_checkpoint), 
-                         map_location="cpu", 
-            )
+        model = VampNet.load(location=Path(fine_tune_checkpoint),
+                             map_location="cpu",
         )
         
     if resume:
@@ -520,8 +919,34 @@ def load(
 
 
 
-    model = torch.compile(VampNet()) if model is None else model
-    model = accel.prepare_model(model)
+    model = VampNet() if model is None else model
+
+    # freeze before wrapping, so that ddp and the optimizer only ever see
+    # the params we actually train
+    if args["fine_tune"]:
+        lora.mark_only_lora_as_trainable(model)
+        print("marked only lora as trainable.")
+
+    ddp_kwargs = {}
+    if accel.use_ddp:
+        # bigger buckets -> fewer allreduces. grads alias the bucket memory
+        # instead of being copied in, and since the graph is the same
+        # every step ddp can reuse its bucket plan.
+        ddp_kwargs = dict(
+            bucket_cap_mb=ddp_bucket_cap_mb,
+            gradient_as_bucket_view=True,
+            static_graph=True,
+        )
+    model = accel.prepare_model(model, **ddp_kwargs)
+
+    # training shapes are fixed (batch_size x duration), so let inductor specialize.
+    # use compile_mode="default" if autotuning takes too long, or
+    # "reduce-overhead" to replay the forward as cuda graphs (see model_step).
+    # only the transformer's forward is compiled (the codec stays eager under
+    # inference_mode), and in place, so state.model stays the ddp/vampnet module
+    # instead of an OptimizedModule wrapper.
+    if COMPILE:
+        model.compile(mode=compile_mode, dynamic=False)
 
     # assert accel.unwrap(model).n_codebooks == codec.quantizer.n_codebooks
     assert (
@@ -529,12 +954,9 @@ def load(
     )
 
 
-    if accel.world_size > 1:
-        from torch.distributed.optim import ZeroRedundancyOptimizer
-        optimizer = ZeroRedundancyOptimizer(model.parameters(), AdamW)
-        print(f"OPTIMIZER LR is {optimizer.param_groups[0]['lr']}")
-    else:
-        optimizer = AdamW(model.parameters())
+    optimizer = build_optimizer(
+        [p for p in model.parameters() if p.requires_grad], accel
+    )
 
     scheduler = NoamScheduler(optimizer, d_model=accel.unwrap(model).embedding_dim)
     scheduler.step()
@@ -551,6 +973,7 @@ def load(
 
     # a better rng for sampling from our schedule
     rng = torch.quasirandom.SobolEngine(1, scramble=True, seed=args["seed"])  
+    rng = SobolBuffer(rng, accel.device)
 
     # log a model summary w/ num params
     if accel.local_rank == 0:
@@ -559,7 +982,11 @@ def load(
             f.write(repr(accel.unwrap(model)))
 
     # load the datasets
-    train_data, val_data = build_datasets(args, sample_rate)
+    # (pass codes_path to train on precomputed codes instead of audio,
+    # and source_cache_dir to cache the file lists of the audio folders)
+    train_data, val_data = build_datasets(
+        args, sample_rate, codes_path, source_cache_dir
+    )
 
     return State(
         tracker=tracker,
@@ -572,6 +999,10 @@ def load(
         train_data=train_data,
         val_data=val_data,
         grad_clip_val=grad_clip_val,
+        grad_acc_steps=grad_acc_steps,
+        metrics_freq=metrics_freq,
+        autocast_dtype=getattr(torch, autocast_dtype),
+        codec_dtype=getattr(torch, codec_dtype) if codec_dtype else None,
     )
 
 
@@ -588,7 +1019,8 @@ def train(
     val_freq: int = 1000,
     batch_size: int = 12,
     val_idx: list = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9],
-    num_workers: int = 10,
+    num_workers: int = min(os.cpu_count() or 1, 10),
+    prefetch_factor: int = 4,
     fine_tune: bool = False, 
 ):
     assert codec_ckpt is not None, "codec_ckpt is required"
@@ -613,29 +1045,43 @@ def train(
         save_path=save_path)
     print("initialized state.")
 
+    # keep more batches in flight per worker. torch only accepts
+    # prefetch_factor when there are workers.
+    loader_kwargs = {}
+    if num_workers > 0:
+        loader_kwargs["prefetch_factor"] = prefetch_factor
+
     train_dataloader = accel.prepare_dataloader(
         state.train_data,
-        start_idx=state.tracker.step * batch_size,
+        # each step consumes grad_acc_steps batches
+        start_idx=state.tracker.step * batch_size * state.grad_acc_steps,
         num_workers=num_workers,
         batch_size=batch_size,
-        collate_fn=state.train_data.collate,
+        collate_fn=build_collate(state.train_data),
+        pin_memory=True,
+        persistent_workers=num_workers > 0,
+        # a ragged last batch would change the shapes the model was compiled for
+        drop_last=True,
+        **loader_kwargs,
     )
+    # overlap the copy of the next training batch with the current step
+    train_dataloader = CUDAPrefetcher(train_dataloader, accel.device)
     val_dataloader = accel.prepare_dataloader(
         state.val_data,
         start_idx=0,
         num_workers=num_workers,
         batch_size=batch_size,
-        collate_fn=state.val_data.collate,
+        collate_fn=build_collate(state.val_data),
+        pin_memory=True,
         persistent_workers=num_workers > 0,
+        # keep the last partial batch, so val covers the full val set.
+        # (at most one extra graph gets compiled for its shape)
+        drop_last=False,
+        **loader_kwargs,
     )
     print("initialized dataloader.")
 
     
-
-    if fine_tune:
-        lora.mark_only_lora_as_trainable(state.model)
-        print("marked only lora as trainable.")
-
     # Wrap the functions so that they neatly track in TensorBoard + progress bars
     # and only run when specific conditions are met.
     global train_loop, val_loop, validate, save_samples, checkpoint
@@ -650,9 +1096,11 @@ def train(
     checkpoint = when(lambda: accel.local_rank == 0)(checkpoint)
 
     print("starting training loop.")
+    state.model.train()
     with tracker.live:
-        for tracker.step, batch in enumerate(train_dataloader, start=tracker.step):
-            train_loop(state, batch, accel)
+        train_batches = _grouped(train_dataloader, state.grad_acc_steps)
+        for tracker.step, batches in enumerate(train_batches, start=tracker.step):
+            train_loop(state, batches, accel)
 
             last_iter = (
                 tracker.step == num_iters - 1 if num_iters is not None else False
@@ -0,0 +1,76 @@
+import os
+import sys
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+import pytest
+
+# the training scripts aren't a package, so put them on the path for the tests.
+# (and run eager, so the tests don't wait on inductor)
+os.environ.setdefault("VAMPNET_COMPILE", "0")
+sys.path.insert(0, str(Path(__file__).parents[1] / "scripts" / "exp"))
+
+from vampnet.modules.transformer import VampNet
+
+
+class _Quantizer(nn.Module):
+    def __init__(self, vocab_size: int, latent_dim: int):
+        super().__init__()
+        self.codebook = nn.Embedding(vocab_size, latent_dim)
+        self.codebook_size = vocab_size
+
+
+class _ResidualQuantizer(nn.Module):
+    def __init__(self, n_codebooks: int, vocab_size: int, latent_dim: int):
+        super().__init__()
+        self.quantizers = nn.ModuleList(
+            [_Quantizer(vocab_size, latent_dim) for _ in range(n_codebooks)]
+        )
+
+
+class FakeCodec(nn.Module):
+    """
+    stands in for the codec: just the codebooks vampnet embeds with,
+    and an encode that maps each hop of audio to a code deterministically.
+    """
+
+    def __init__(
+        self, n_codebooks=4, vocab_size=32, latent_dim=8, hop_length=4, sample_rate=400
+    ):
+        super().__init__()
+        self.quantizer = _ResidualQuantizer(n_codebooks, vocab_size, latent_dim)
+        self.n_codebooks = n_codebooks
+        self.vocab_size = vocab_size
+        self.hop_length = hop_length
+        self.sample_rate = sample_rate
+
+    def encode(self, audio_data, sample_rate):
+        b, _, n = audio_data.shape
+        frames = audio_data[..., : n - n % self.hop_length].mean(dim=1)
+        frames = frames.reshape(b, 1, -1, self.hop_length).sum(dim=-1)
+        offsets = torch.arange(self.n_codebooks, device=audio_data.device)
+        codes = (frames * 1000).long() + offsets[None, :, None]
+        return {"codes": codes.remainder(self.vocab_size)}
+
+
+@pytest.fixture
+def codec():
+    torch.manual_seed(0)
+    return FakeCodec()
+
+
+def small_vampnet(**kwargs):
+    args = dict(
+        n_heads=2,
+        n_layers=2,
+        n_codebooks=4,
+        latent_dim=8,
+        embedding_dim=32,
+        vocab_size=32,
+        flash_attn=False,
+        dropout=0.0,
+    )
+    args.update(kwargs)
+    torch.manual_seed(0)
+    return VampNet(**args)
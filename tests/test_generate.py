@@ -0,0 +1,105 @@
+import torch
+
+import vampnet.modules.transformer as transformer
+from conftest import small_vampnet
+
+
+def test_generate_int32_start_tokens(codec):
+    model = small_vampnet(n_conditioning_codebooks=1).eval()
+    z = torch.randint(0, 32, (2, 4, 16))
+
+    outs = []
+    for dtype in (torch.int64, torch.int32):
+        torch.manual_seed(1)
+        outs.append(
+            model.generate(
+                codec,
+                time_steps=16,
+                start_tokens=z.to(dtype),
+                sampling_steps=4,
+                return_signal=False,
+            )
+        )
+
+    assert outs[1].dtype == torch.long
+    assert torch.equal(outs[0], outs[1])
+
+
+def _batch_masks(t: int):
+    # a different amount of masking for every row
+    mask = torch.zeros(3, 4, t, dtype=torch.long)
+    mask[0, 1:, :] = 1
+    mask[1, 1:, : t // 2] = 1
+    mask[2, 1:, ::3] = 1
+    return mask
+
+
+def test_generate_batch_matches_single_examples(codec):
+    model = small_vampnet(n_conditioning_codebooks=1).eval()
+    z = torch.randint(0, 32, (3, 4, 16))
+    mask = _batch_masks(16)
+
+    # greedy sampling and no mask noise, so the output is deterministic
+    kw = dict(
+        time_steps=16, sampling_steps=8, return_signal=False,
+        sample_cutoff=-1.0, mask_temperature=0.0,
+    )
+    batched = model.generate(codec, start_tokens=z, mask=mask, **kw)
+    single = torch.cat([
+        model.generate(codec, start_tokens=z[i : i + 1], mask=mask[i : i + 1], **kw)
+        for i in range(z.shape[0])
+    ])
+
+    assert torch.equal(batched, single)
+
+
+def _mask_schedule(monkeypatch, model, codec, **kw):
+    # record how many tokens each row still has masked after every step
+    remaining = []
+    remask = transformer._remask
+
+    def _recording_remask(sampled_z, selected_probs, z_flat, *args, **kwargs):
+        remask(sampled_z, selected_probs, z_flat, *args, **kwargs)
+        remaining.append((z_flat == model.mask_token).sum(dim=-1))
+
+    monkeypatch.setattr(transformer, "_remask", _recording_remask)
+    model.generate(codec, return_signal=False, **kw)
+    monkeypatch.undo()
+    return torch.stack(remaining, dim=1)  # b, steps
+
+
+def test_generate_batch_follows_per_example_schedule(monkeypatch, codec):
+    # (the batched path save_sampled / save_imputation use)
+    model = small_vampnet(n_conditioning_codebooks=1).eval()
+    z = torch.randint(0, 32, (3, 4, 16))
+    mask = _batch_masks(16)
+    kw = dict(time_steps=16, sampling_steps=8, seed=0)
+
+    batched = _mask_schedule(
+        monkeypatch, model, codec, start_tokens=z, mask=mask, **kw
+    )
+    for i in range(z.shape[0]):
+        single = _mask_schedule(
+            monkeypatch, model, codec,
+            start_tokens=z[i : i + 1], mask=mask[i : i + 1], **kw
+        )
+        assert torch.equal(batched[i], single[0])
+
+
+def test_compiled_forward_cache_invalidated():
+    model = small_vampnet().eval()
+
+    def compiled():
+        # (torch.compile is lazy, so nothing actually compiles here)
+        return model._get_compiled_forward().func
+
+    first = compiled()
+    assert compiled() is first
+    assert not any("compiled" in k for k in model.state_dict())
+
+    model.train()
+    trained = compiled()
+    assert trained is not first
+
+    model.remove_weight_norm()
+    assert compiled() is not trained
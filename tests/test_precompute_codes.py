@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import audiotools as at
+from audiotools import AudioSignal
+
+import train
+from conftest import FakeCodec
+from precompute_codes import write_codes
+
+
+class _ToyDataset(torch.utils.data.Dataset):
+    """
+    like at.datasets.AudioDataset (every item is a deterministic function of its
+    index, transform args included), without reading audio files.
+    """
+
+    def __init__(self, sample_rate, n_examples):
+        self.sample_rate = sample_rate
+        self.n_examples = n_examples
+        self.transform = train.build_transform()
+
+    def __len__(self):
+        return self.n_examples
+
+    def __getitem__(self, idx):
+        state = at.util.random_state(idx)
+        audio = state.randn(1, 1, self.sample_rate // 10) * state.uniform(0.01, 0.5)
+        signal = AudioSignal(torch.from_numpy(audio).float(), self.sample_rate)
+        return {
+            "signal": signal,
+            "transform_args": self.transform.instantiate(state, signal=signal),
+            "idx": idx,
+        }
+
+    @staticmethod
+    def collate(list_of_dicts):
+        return at.util.collate(list_of_dicts)
+
+
+def test_codes_match_encoding_the_train_data(tmp_path):
+    codec = FakeCodec(sample_rate=16000)
+    train_data = _ToyDataset(codec.sample_rate, n_examples=5)
+
+    codes_path = tmp_path / "codes" / "train.npy"
+    write_codes(codec, train_data, str(codes_path), batch_size=2, num_workers=0)
+    assert np.load(codes_path, mmap_mode="r").dtype == np.int16
+
+    # longer than the file, so the last items wrap around
+    codes_data = train.CodesDataset(str(codes_path), n_examples=2 * len(train_data))
+    state = SimpleNamespace(codec=codec, codec_dtype=None)
+    for i in range(len(train_data)):
+        batch = train.build_collate(train_data)([train_data[i]])
+        signal = train.apply_transform(train_data.transform, batch)
+        expected = train.encode(state, signal, codec.n_codebooks)[0]
+
+        assert torch.equal(codes_data[i]["codes"], expected)
+        assert torch.equal(codes_data[i + len(train_data)]["codes"], expected)
@@ -0,0 +1,116 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+import train
+from conftest import small_vampnet
+
+
+def _state(model, codec, grad_acc_steps):
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+    return SimpleNamespace(
+        model=model,
+        codec=codec,
+        optimizer=optimizer,
+        scheduler=torch.optim.lr_scheduler.LambdaLR(optimizer, lambda _: 1.0),
+        criterion=torch.nn.CrossEntropyLoss(label_smoothing=0.1),
+        grad_clip_val=1e9,
+        grad_acc_steps=grad_acc_steps,
+        metrics_freq=1,
+        autocast_dtype=torch.bfloat16,
+        codec_dtype=None,
+        rng=train.SobolBuffer(
+            torch.quasirandom.SobolEngine(1, scramble=True, seed=0), "cpu"
+        ),
+        tracker=SimpleNamespace(step=0),
+    )
+
+
+def _random_mask(z, r):
+    # a mask that only depends on the codes, so each example gets the same
+    # mask however the batch is split (with a different number of masked tokens)
+    return (z % 3 == 0).long()
+
+
+def test_grad_accumulation_matches_full_batch(codec, monkeypatch):
+    monkeypatch.setattr(train.pmask, "random", _random_mask)
+    accel = train.Accelerator()
+
+    torch.manual_seed(0)
+    codes = torch.randint(0, 32, (4, 4, 12))
+
+    # (small_vampnet is seeded, so both start from the same weights)
+    full = _state(small_vampnet().train(), codec, grad_acc_steps=1)
+    acc = _state(small_vampnet().train(), codec, grad_acc_steps=2)
+
+    out_full = train.train_loop(full, [{"codes": codes}], accel)
+    # unequal micro batches, with unequal mask counts
+    out_acc = train.train_loop(
+        acc, [{"codes": codes[:1]}, {"codes": codes[1:]}], accel
+    )
+
+    assert abs(out_full["loss"] - out_acc["loss"]) < 1e-5
+    assert out_acc["other/batch_size"] == 4
+    for p_full, p_acc in zip(full.model.parameters(), acc.model.parameters()):
+        assert torch.allclose(p_full, p_acc, atol=1e-5)
+
+
+def test_grouped_drops_incomplete_group():
+    assert list(train._grouped(range(7), 3)) == [[0, 1, 2], [3, 4, 5]]
+    assert list(train._grouped(range(2), 1)) == [[0], [1]]
+
+
+def test_train_metrics_only_logged_on_metric_steps(codec, tmp_path):
+    accel = train.Accelerator()
+    logged = []
+    writer = SimpleNamespace(add_scalar=lambda k, v, step: logged.append((k, step)))
+    tracker = train.Tracker(writer=writer, log_file=str(tmp_path / "log.txt"))
+
+    state = _state(small_vampnet().train(), codec, grad_acc_steps=1)
+    state.tracker = tracker
+    state.metrics_freq = 2
+    train_loop = tracker.log("train", "value", history=False)(
+        tracker.track("train", 4)(train.train_loop)
+    )
+
+    codes = torch.randint(0, 32, (2, 4, 12))
+    for tracker.step in range(3):
+        train_loop(state, [{"codes": codes}], accel)
+
+    acc_steps = {step for k, step in logged if k.startswith("accuracy")}
+    loss_steps = {step for k, step in logged if k.startswith("loss")}
+    assert acc_steps == {0, 2}
+    assert loss_steps == {0, 1, 2}
+
+
+def test_sobol_buffer_matches_sequential_draws():
+    engine = torch.quasirandom.SobolEngine(1, scramble=True, seed=0)
+    expected = torch.cat([engine.draw(1) for _ in range(40)])
+
+    engine = torch.quasirandom.SobolEngine(1, scramble=True, seed=0)
+    # a small block, so the draws cross several refills (and one is bigger than a block)
+    buffer = train.SobolBuffer(engine, "cpu", block_size=8)
+    sizes = [3, 1, 8, 12, 5, 11]
+    draws = [buffer.draw(n) for n in sizes]
+
+    assert [d.shape for d in draws] == [(n, 1) for n in sizes]
+    assert torch.equal(torch.cat(draws), expected)
+
+
+def test_cuda_prefetcher_cpu_fallback(monkeypatch):
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: False)
+    batches = [{"x": torch.full((2,), float(i))} for i in range(5)]
+    prefetcher = train.CUDAPrefetcher(batches, "cpu")
+    assert prefetcher.stream is None
+    assert len(prefetcher) == 5
+
+    it = iter(prefetcher)
+    seen = [next(it)["x"][0].item() for _ in range(5)]
+    assert seen == [0.0, 1.0, 2.0, 3.0, 4.0]
+    with pytest.raises(StopIteration):
+        next(it)
+
+    # can be iterated again (once per epoch), and an empty loader yields nothing
+    assert len(list(prefetcher)) == 5
+    assert list(train.CUDAPrefetcher([], "cpu")) == []
@@ -28,6 +28,7 @@ def _load_model(
     lora_ckpt: str = None,
     device: str = "cpu",
     chunk_size_s: int = 10,
+    quantize: str = None,
 ):
     # we need to set strict to False if the model has lora weights to add later
     model = VampNet.load(location=Path(ckpt), map_location="cpu", strict=False)
@@ -43,8 +44,12 @@ def _load_model(
         else:
             model.load_state_dict(torch.load(lora_ckpt, map_location="cpu"), strict=False)
 
-    model.to(device)
     model.eval()
+    model.remove_weight_norm()
+    if quantize is not None:
+        # needs to happen before the model is moved to the gpu
+        model.quantize(quantize)
+    model.to(device)
     model.chunk_size_s = chunk_size_s
     return model
 
@@ -62,6 +67,7 @@ class Interface(torch.nn.Module):
         device: str = "cpu",
         coarse_chunk_size_s: int =  10, 
         coarse2fine_chunk_size_s: int =  3,
+        quantize: str = None,
     ):
         super().__init__()
         assert codec_ckpt is not None, "must provide a codec checkpoint"
@@ -69,12 +75,16 @@ class Interface(torch.nn.Module):
         self.codec.eval()
         self.codec.to(device)
 
+        # optionally quantize the transformers with bitsandbytes ("int8" or "nf4")
+        self.quantize = quantize
+
         assert coarse_ckpt is not None, "must provide a coarse checkpoint"
         self.coarse = _load_model(
             ckpt=coarse_ckpt,
             lora_ckpt=coarse_lora_ckpt,
             device=device,
             chunk_size_s=coarse_chunk_size_s,
+            quantize=quantize,
         )
 
         # check if we have a coarse2fine ckpt
@@ -84,6 +94,7 @@ class Interface(torch.nn.Module):
                 lora_ckpt=coarse2fine_lora_ckpt,
                 device=device,
                 chunk_size_s=coarse2fine_chunk_size_s,
+                quantize=quantize,
             )
         else:
             self.c2f = None
@@ -109,12 +120,14 @@ class Interface(torch.nn.Module):
                     ckpt=coarse_ckpt,  
                     device=self.device,
                     chunk_size_s=self.coarse.chunk_size_s,
+                    quantize=self.quantize,
                 )
             if c2f_ckpt is not None:
                 self.c2f = _load_model(
                     ckpt=c2f_ckpt,
                     device=self.device,
                     chunk_size_s=self.c2f.chunk_size_s,
+                    quantize=self.quantize,
                 )
         else:
             if coarse_ckpt is not None:
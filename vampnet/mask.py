@@ -1,3 +1,4 @@
+import random as pyrandom
 from typing import Optional
 
 import torch
@@ -32,8 +33,7 @@ def apply_mask(
     assert ~torch.any(mask > 1), "mask must be binary"
     assert ~torch.any(mask < 0), "mask must be binary"
 
-    fill_x = torch.full_like(x, mask_token)
-    x = x * (1 - mask) + fill_x * mask
+    x = torch.where(mask.bool(), mask_token, x)
 
     return x, mask
 
@@ -105,27 +105,32 @@ def periodic_mask(x: torch.Tensor,
     if period == 0:
         return mask
 
+    if random_roll:
+        # the roll offset is drawn on the host, so take its bound from the
+        # host value, before the period is moved to x's device
+        max_offset = int(period if not isinstance(period, torch.Tensor) else period[0])
+
     if not isinstance(period, torch.Tensor):
         period = scalar_to_batch_tensor(period, x.shape[0])
-    for i, factor in enumerate(period):
-        if factor == 0:
-            continue
-        for j in range(mask.shape[-1]):
-            if j % factor == 0:
-                # figure out how wide the mask should be
-                j_start = max(0, j - width // 2  )
-                j_end = min(mask.shape[-1] - 1, j + width // 2 ) + 1 
-                # flip a coin for each position in the mask
-                j_mask = torch.bernoulli(torch.ones(j_end - j_start))
-                assert torch.all(j_mask == 1)
-                j_fill = torch.ones_like(j_mask) * (1 - j_mask)
-                assert torch.all(j_fill == 0)
-                # fill
-                mask[i, :, j_start:j_end] = j_fill
+    period = period.to(x.device).long()
+
+    # unmask a window of width positions centered on every multiple of the period
+    # (rows with a period of 0 stay fully masked)
+    seq_len = mask.shape[-1]
+    half = width // 2
+    pos = torch.arange(seq_len, device=x.device)[None, :]
+    factor = period.clamp(min=1)[:, None]
+    dist = pos % factor
+    # distance to the previous multiple, or to the next one (if it's in the sequence)
+    unmask = (dist <= half) | (((factor - dist) <= half) & (pos - dist + factor < seq_len))
+    unmask = unmask & (period[:, None] != 0)
+    mask = mask.masked_fill(unmask[:, None, :], 0)
+
     if random_roll:
         # add a random offset to the mask
-        offset = torch.randint(0, period[0], (1,))
-        mask = torch.roll(mask, offset.item(), dims=-1)
+        # (drawn on the host, so there's no device sync)
+        offset = pyrandom.randrange(max_offset)
+        mask = torch.roll(mask, offset, dims=-1)
 
     return mask
 
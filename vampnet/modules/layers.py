@@ -70,8 +70,15 @@ class SequentialWithFiLM(nn.Module):
         return mod_has_film
 
     def forward(self, x, cond):
-        for layer in self.layers:
-            if self.has_film(layer):
+        # walking the module tree to find FiLM layers is slow python work,
+        # so only do it once instead of on every forward pass
+        film_layers = getattr(self, "_film_layers", None)
+        if film_layers is None:
+            film_layers = [self.has_film(layer) for layer in self.layers]
+            self._film_layers = film_layers
+
+        for layer, layer_has_film in zip(self.layers, film_layers):
+            if layer_has_film:
                 x = layer(x, cond)
             else:
                 x = layer(x)
@@ -131,29 +138,77 @@ class CodebookEmbedding(nn.Module):
 
         self.out_proj = nn.Conv1d(n_codebooks * self.latent_dim, self.emb_dim, 1)
 
-    def from_codes(self, codes: torch.Tensor, codec):
+    def from_codes(self, codes: torch.Tensor, codec, lookup_table: torch.Tensor = None):
         """ 
         get a sequence of continuous embeddings from a sequence of discrete codes. 
         unlike it's counterpart in the original VQ-VAE, this function adds for any special tokens
         necessary for the language model, like <MASK>. 
+
+        pass a precomputed `lookup_table` (see `lookup_table()`) to avoid
+        rebuilding it on every call, e.g. when sampling.
         """
-        n_codebooks = codes.shape[1]
-        latent = []
-        for i in range(n_codebooks):
-            c = codes[:, i, :]
-
-            lookup_table = codec.quantizer.quantizers[i].codebook.weight
-            if hasattr(self, "special"):
-                special_lookup = torch.cat(
-                    [self.special[tkn][i : i + 1] for tkn in self.special], dim=0
-                )
-                lookup_table = torch.cat([lookup_table, special_lookup], dim=0)
+        nb, n_codebooks, nt = codes.shape
+        if lookup_table is None:
+            lookup_table = self.lookup_table(codec, n_codebooks)
+
+        # offset each codebook's codes into its block of the stacked table,
+        # so all codebooks are looked up with a single embedding call
+        n_rows = lookup_table.shape[0] // n_codebooks
+        offsets = torch.arange(n_codebooks, device=codes.device) * n_rows
+        latent = F.embedding(codes + offsets.view(1, -1, 1), lookup_table)
+
+        # b c t d -> b (c d) t
+        latent = latent.permute(0, 1, 3, 2).reshape(nb, n_codebooks * self.latent_dim, nt)
+        return latent
 
-            l = F.embedding(c, lookup_table).transpose(1, 2)
-            latent.append(l)
+    def lookup_table(self, codec, n_codebooks: int = None):
+        """
+        stack the codec's codebooks (plus our special tokens) into a single
+        lookup table of shape (n_codebooks * (vocab_size + n_special), latent_dim).
+        the rows for codebook i start at i * (vocab_size + n_special).
+        """
+        n_codebooks = self.n_codebooks if n_codebooks is None else n_codebooks
+        table = torch.stack(
+            [codec.quantizer.quantizers[i].codebook.weight for i in range(n_codebooks)]
+        )
+        if hasattr(self, "special"):
+            special = torch.stack([self.special[tkn] for tkn in self.special], dim=1)
+            special = special[:n_codebooks].to(table.dtype)
+            if special.shape[0] < n_codebooks:
+                # codebooks we don't have special tokens for
+                special = F.pad(special, (0, 0, 0, 0, 0, n_codebooks - special.shape[0]))
+            table = torch.cat([table, special], dim=1)
+        return table.reshape(-1, table.shape[-1])
+
+    def folded_table(self, codec):
+        """
+        fold out_proj into the lookup table. out_proj is a 1x1 conv over the
+        concatenated codebook latents, so out_proj(from_codes(codes)) is just the
+        sum over codebooks of (table_i @ W_i^T)[codes_i], plus the bias.
+        returns a (n_codebooks * (vocab_size + n_special), emb_dim) table for
+        `embed_codes`. it's a snapshot of the weights, so it's for inference only.
+        """
+        table = self.lookup_table(codec, self.n_codebooks)
+        table = table.view(self.n_codebooks, -1, self.latent_dim)
+        weight = self.out_proj.weight.view(self.emb_dim, self.n_codebooks, self.latent_dim)
+        folded = torch.einsum("crd,ecd->cre", table, weight)
+        return folded.reshape(-1, self.emb_dim)
 
-        latent = torch.cat(latent, dim=1)
-        return latent
+    def embed_codes(self, codes: torch.Tensor, folded_table: torch.Tensor, bias: bool = True):
+        """
+        embed a (batch, codebook, time) sequence of codes with a table from
+        `folded_table` (or a slice of one holding just those codebooks), as a single
+        embedding_bag sum over the codebooks. same as `self(self.from_codes(codes))`,
+        but returns shape (batch, time, emb_dim).
+        """
+        nb, n_codebooks, nt = codes.shape
+        n_rows = folded_table.shape[0] // n_codebooks
+        offsets = torch.arange(n_codebooks, device=codes.device) * n_rows
+        bags = (codes + offsets.view(1, -1, 1)).transpose(1, 2).reshape(nb * nt, n_codebooks)
+        x = F.embedding_bag(bags, folded_table, mode="sum")
+        if bias and self.out_proj.bias is not None:
+            x = x + self.out_proj.bias
+        return x.view(nb, nt, self.emb_dim)
 
     def forward(self, latents: torch.Tensor):
         """
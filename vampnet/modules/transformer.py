@@ -1,5 +1,7 @@
 import math
 import logging
+import functools
+import weakref
 from typing import Optional, Tuple, Union
 
 import numpy as np
@@ -15,7 +17,7 @@ from .layers import CodebookEmbedding
 from .layers import FiLM
 from .layers import SequentialWithFiLM
 from .layers import WNConv1d
-from ..util import scalar_to_batch_tensor, codebook_flatten, codebook_unflatten
+from ..util import codebook_flatten, codebook_unflatten
 from ..mask import _gamma
 
 LORA_R = 8
@@ -25,8 +27,9 @@ LORA_R = 8
 
 
 def gumbel_noise_like(t):
-    noise = torch.zeros_like(t).uniform_(1e-20, 1)
-    return -torch.log(-torch.log(noise))
+    # if E ~ Exp(1) then -log(E) ~ Gumbel(0, 1). one sampling kernel
+    # and an in-place log instead of uniform + two logs.
+    return torch.empty_like(t).exponential_().log_().neg_()
 
 
 def gumbel_sample(t, temperature=1.0, dim=-1):
@@ -119,6 +122,9 @@ class MultiHeadRelativeAttention(nn.Module):
         if has_relative_attention_bias:
             self.relative_attention_bias = nn.Embedding(attention_num_buckets, n_head)
 
+        # cache of relative position buckets, built on the same device as the bias
+        self._position_bucket = None
+
     def _relative_position_bucket(self, relative_position):
         """Converts unbounded relative position into bounded set of buckets
         with half "exact" buckets (1 position = 1 bucket) and half "log-spaced"
@@ -190,16 +196,32 @@ class MultiHeadRelativeAttention(nn.Module):
         Tensor[heads x 1 x T_q x T_kv]
             Position bias to be applied on attention logits
         """
-
-        query_position = torch.arange(query_length, dtype=torch.long)[:, None]
-        key_position = torch.arange(key_length, dtype=torch.long)[None, :]
-        relative_position = key_position - query_position
-
-        # Convert relative position to buckets
-        relative_position_bucket = self._relative_position_bucket(relative_position)
-        relative_position_bucket = relative_position_bucket.to(
-            self.relative_attention_bias.weight.device
-        )
+        device = self.relative_attention_bias.weight.device
+
+        # the buckets only depend on the sequence lengths, so we build them
+        # once on the device and reuse them instead of copying them over every step
+        relative_position_bucket = self._position_bucket
+        if (
+            relative_position_bucket is None
+            or relative_position_bucket.shape != (query_length, key_length)
+            or relative_position_bucket.device != device
+            # buckets built under inference mode can't be saved for backward
+            or (
+                relative_position_bucket.is_inference()
+                and not torch.is_inference_mode_enabled()
+            )
+        ):
+            query_position = torch.arange(
+                query_length, dtype=torch.long, device=device
+            )[:, None]
+            key_position = torch.arange(
+                key_length, dtype=torch.long, device=device
+            )[None, :]
+            relative_position = key_position - query_position
+
+            # Convert relative position to buckets
+            relative_position_bucket = self._relative_position_bucket(relative_position)
+            self._position_bucket = relative_position_bucket
 
         # Index attention bias values
         values = self.relative_attention_bias(relative_position_bucket)
@@ -525,20 +547,28 @@ class VampNet(at.ml.BaseModel):
             ),
         )
 
-    def forward(self, x, return_activations: bool = False):
-        x = self.embedding(x)
-        x_mask = torch.ones_like(x, dtype=torch.bool)[:, :1, :].squeeze(1)
+    def forward(self, x, return_activations: bool = False, pre_embedded: bool = False):
+        # pre_embedded: x was already projected by the embedding (see
+        # CodebookEmbedding.embed_codes), so skip the projection here
+        if not pre_embedded:
+            x = self.embedding(x)
+        # (b, n), without building a full (b, d, n) tensor first
+        x_mask = torch.ones(x.shape[0], x.shape[-1], dtype=torch.bool, device=x.device)
 
-        x = rearrange(x, "b d n -> b n d")
+        # plain view ops instead of einops, which parses its pattern on every call
+        x = x.transpose(1, 2) # b d n -> b n d
         out = self.transformer(x=x, x_mask=x_mask, return_activations=return_activations)
         if return_activations:
             out, activations = out
 
-        out = rearrange(out, "b n d -> b d n")
+        out = out.transpose(1, 2) # b n d -> b d n
 
         out = self.classifier(out, None) # no cond here!
 
-        out = rearrange(out, "b (p c) t -> b p (t c)", c=self.n_predict_codebooks)
+        # b (p c) t -> b p (t c)
+        b, _, t = out.shape
+        c = self.n_predict_codebooks
+        out = out.view(b, -1, c, t).transpose(2, 3).reshape(b, -1, t * c)
 
         if return_activations:
             return out, activations
@@ -565,6 +595,117 @@ class VampNet(at.ml.BaseModel):
         else:
             return r
     
+    def _get_compiled_forward(self):
+        """
+        the forward pass compiled with cuda graphs, for generate. it's cached
+        outside the module (so it doesn't end up in state_dict or pickles) and
+        recompiled whenever the model's device, dtype or train/eval mode has
+        changed since, or after remove_weight_norm() / quantize().
+        """
+        param = next(self.parameters())
+        key = (param.device, param.dtype, self.training)
+        cached = _compiled_forwards.get(self)
+        if cached is None or cached[0] != key:
+            # compile the unbound forward, so the cache doesn't hold a
+            # reference to the module (which would keep it alive)
+            compiled_forward = torch.compile(
+                type(self).forward, mode="reduce-overhead", dynamic=False
+            )
+            cached = (key, compiled_forward)
+            _compiled_forwards[self] = cached
+        return functools.partial(cached[1], self)
+
+    def to_torchscript(self, example_latents: torch.Tensor):
+        """
+        export the forward pass as a frozen, inference-optimized torchscript
+        module (for cpu deployment). the model is traced rather than scripted
+        (the attention layers use einops, which doesn't script), so the result
+        is specialized to the sequence length of `example_latents`, which should
+        have shape (batch, n_codebooks * latent_dim, seq).
+        """
+        assert not self.flash_attn, "flash attention can't be exported to torchscript"
+        self.eval()
+        with torch.no_grad():
+            # warm up the relative position bucket cache, so every traced
+            # run sees the same (constant) buckets
+            self(example_latents)
+            traced = torch.jit.trace(self, example_latents)
+            traced = torch.jit.freeze(traced)
+            return torch.jit.optimize_for_inference(traced)
+
+    def remove_weight_norm(self):
+        """
+        fold the weight norm parametrization into plain weights, so it isn't
+        recomputed on every forward pass. for inference only.
+        """
+        for module in self.modules():
+            if hasattr(module, "weight_g") and hasattr(module, "weight_v"):
+                nn.utils.remove_weight_norm(module)
+        # the compiled forward was traced with the weight norm in it
+        _compiled_forwards.pop(self, None)
+        return self
+
+    def quantize(self, mode: str = "int8"):
+        """
+        swap the transformer's linear layers for bitsandbytes int8 or nf4 (4 bit)
+        linears, for inference. call this after .eval() (so lora weights are
+        merged), and before moving the model to the gpu, which is when
+        bitsandbytes actually quantizes the weights.
+        raises a ValueError for an unknown mode, if cuda isn't available (the
+        bitsandbytes layers only run on gpu), or if the model is already on the
+        gpu, and an ImportError if bitsandbytes isn't installed.
+        """
+        if mode not in ("int8", "nf4"):
+            raise ValueError(f"unknown quantization mode {mode}, expected 'int8' or 'nf4'")
+        if not torch.cuda.is_available():
+            raise ValueError("quantizing needs cuda, the bitsandbytes layers only run on gpu")
+        if self.device.type == "cuda":
+            raise ValueError(
+                "quantize the model before moving it to the gpu, "
+                "bitsandbytes quantizes the weights when they're moved"
+            )
+        try:
+            import bitsandbytes as bnb
+        except ImportError as e:
+            raise ImportError(
+                "quantizing needs bitsandbytes (pip install bitsandbytes)"
+            ) from e
+
+        def _quantized(linear: nn.Linear):
+            has_bias = linear.bias is not None
+            weight = linear.weight.data
+            if mode == "int8":
+                q = bnb.nn.Linear8bitLt(
+                    linear.in_features, linear.out_features, bias=has_bias,
+                    has_fp16_weights=False, threshold=6.0,
+                )
+                q.weight = bnb.nn.Int8Params(
+                    weight, requires_grad=False, has_fp16_weights=False
+                )
+            else:
+                q = bnb.nn.Linear4bit(
+                    linear.in_features, linear.out_features, bias=has_bias,
+                    compute_dtype=torch.bfloat16, quant_type="nf4",
+                )
+                q.weight = bnb.nn.Params4bit(
+                    weight, requires_grad=False, quant_type="nf4"
+                )
+            if has_bias:
+                q.bias = nn.Parameter(linear.bias.data, requires_grad=False)
+            return q
+
+        def _swap(module: nn.Module):
+            for name, child in module.named_children():
+                if isinstance(child, nn.Linear):
+                    setattr(module, name, _quantized(child))
+                else:
+                    _swap(child)
+
+        # the transformer holds nearly all of the weights
+        _swap(self.transformer)
+        _compiled_forwards.pop(self, None)
+        return self
+
     @torch.no_grad()
     def to_signal(self, z, codec):
         """
@@ -579,12 +720,12 @@ class VampNet(at.ml.BaseModel):
             codec.sample_rate,
         )
 
-        # find where the mask token is and replace it with silence in the audio
-        for tstep in range(z.shape[-1]):
-            if torch.any(z[:, :, tstep] == self.mask_token):
-                sample_idx_0 = tstep * codec.hop_length
-                sample_idx_1 = sample_idx_0 + codec.hop_length
-                signal.samples[:, :, sample_idx_0:sample_idx_1] = 0.0
+        # find where the mask token is and replace it with silence in the audio.
+        # (done for all timesteps at once, checking each one would sync every step)
+        masked_tsteps = (z == self.mask_token).any(dim=1).any(dim=0)
+        sample_mask = masked_tsteps.repeat_interleave(codec.hop_length)
+        n_samples = min(sample_mask.shape[0], signal.samples.shape[-1])
+        signal.samples[..., :n_samples].masked_fill_(sample_mask[:n_samples], 0.0)
 
         return signal
 
@@ -606,10 +747,21 @@ class VampNet(at.ml.BaseModel):
         return_signal=True,
         seed: int = None, 
         sample_cutoff: float = 1.0,
+        compile_forward: bool = False,
+        autocast_dtype: Optional[torch.dtype] = torch.bfloat16,
+        compile_sampling: bool = False,
     ):
         if seed is not None:
             at.util.seed(seed)
-        logging.debug(f"beginning generation with {sampling_steps} steps")
+        logging.debug("beginning generation with %s steps", sampling_steps)
+
+        # every sampling step runs the forward pass on the same shapes, so
+        # it's a good fit for cuda graphs (compiled once, reused after that)
+        forward = self._get_compiled_forward() if compile_forward else self.forward
+        use_autocast = autocast_dtype is not None and self.device.type == "cuda"
+        # the remasking is a chain of small elementwise ops + a sort over the
+        # same (b, n_infer * t) tensors, which inductor can fuse into a few kernels
+        remask = _get_compiled_remask() if compile_sampling else _remask
 
 
 
@@ -617,13 +769,17 @@ class VampNet(at.ml.BaseModel):
         # resolve initial z #
         #####################
         z = start_tokens
+        if z is not None:
+            # the sampling loop writes int64 samples into z's buffers in place
+            # (see _remask), so they need to be int64 too
+            z = z.long()
 
         if z is None:
             z = torch.full((1, self.n_codebooks, time_steps), self.mask_token).to(
                 self.device
             )
 
-        logging.debug(f"created z with shape {z.shape}")
+        logging.debug("created z with shape %s", z.shape)
 
 
         #################
@@ -637,7 +793,7 @@ class VampNet(at.ml.BaseModel):
             mask = mask[:, None, :].repeat(1, z.shape[1], 1)
         # init_mask = mask.clone()
         
-        logging.debug(f"created mask with shape {mask.shape}")
+        logging.debug("created mask with shape %s", mask.shape)
 
 
         ###########
@@ -647,40 +803,73 @@ class VampNet(at.ml.BaseModel):
         z_masked = z.masked_fill(mask.bool(), self.mask_token)
         # logging.debug(f"z_masked: {z_masked}")
 
-        # how many mask tokens to begin with?
-        num_mask_tokens_at_start = (z_masked == self.mask_token).sum()
-        logging.debug(f"num mask tokens at start: {num_mask_tokens_at_start}")
+        # how many mask tokens to begin with? (per example, so each row of
+        # the batch follows its own schedule)
+        num_mask_tokens_at_start = (z_masked == self.mask_token).sum(dim=(1, 2))
+        logging.debug("num mask tokens at start: %s", num_mask_tokens_at_start)
 
         # how many codebooks are we inferring vs conditioning on?
         n_infer_codebooks = self.n_codebooks - self.n_conditioning_codebooks
-        logging.debug(f"n infer codebooks: {n_infer_codebooks}")
+        logging.debug("n infer codebooks: %s", n_infer_codebooks)
+
+        # the codebooks and the embedding don't change while sampling, so fold
+        # the embedding's projection into the lookup table once. each step is then
+        # a single embedding_bag instead of a gather + concat + 1x1 conv.
+        folded_table = self.embedding.folded_table(codec)
+
+        # the sampling logic works on the flattened (b, n_infer * t) tokens of
+        # the codebooks we're inferring. keep those flat across the whole loop,
+        # and only write them back into the (b, c, t) buffer for the forward pass.
+        z_flat = codebook_flatten(z_masked[:, self.n_conditioning_codebooks:, :])
+
+        # the conditioning codebooks don't change after the first step, so we
+        # keep their (summed) embedding around and only re-embed the codebooks
+        # we infer. (rows for codebook i of the table start at i * n_rows)
+        n_cond = self.n_conditioning_codebooks
+        n_rows = folded_table.shape[0] // self.n_codebooks
+        cond_table = folded_table[: n_cond * n_rows]
+        infer_table = folded_table[n_cond * n_rows :]
+        x = self.embedding.embed_codes(z_masked, folded_table) # b, seq, d
+
+        # the schedule only depends on the step, so compute all of it up front
+        # (sampling_steps, b)
+        r_sched = (
+            torch.arange(1, sampling_steps + 1, device=z.device) / sampling_steps
+        )[:, None].expand(-1, z.shape[0])
+        gamma_sched = _gamma(r_sched)
+        mask_temperature_sched = mask_temperature * (1 - r_sched)
+
+        mask_token = torch.tensor(self.mask_token, device=z.device)
 
         #################
         # begin sampling #
         #################
 
         for i in range(sampling_steps):
-            logging.debug(f"step {i} of {sampling_steps}")
+            logging.debug("step %s of %s", i, sampling_steps)
 
             # our current schedule step
-            r = scalar_to_batch_tensor(
-                (i + 1) / sampling_steps, 
-                z.shape[0]
-            ).to(z.device)
-            logging.debug(f"r: {r}")
+            logging.debug("r: %s", r_sched[i])
 
-            # get latents
-            latents = self.embedding.from_codes(z_masked, codec)
-            logging.debug(f"computed latents with shape: {latents.shape}")
+            logging.debug("embeddings with shape: %s", x.shape)
 
 
-            # infer from latents
+            # infer from embeddings
             # NOTE: this collapses the codebook dimension into the sequence dimension
-            logits = self.forward(latents) # b, prob, seq
+            if compile_forward:
+                # the cuda graph reuses its output buffers across calls
+                torch.compiler.cudagraph_mark_step_begin()
+            # the forward pass is bandwidth bound, so run it in half precision
+            # on gpu. the sampling below stays in fp32.
+            with torch.autocast(
+                "cuda", dtype=autocast_dtype, enabled=use_autocast
+            ):
+                logits = forward(x.transpose(1, 2), pre_embedded=True) # b, prob, seq
+            logits = logits.float()
             logits = logits.permute(0, 2, 1)  # b, seq, prob
             b = logits.shape[0]
 
-            logging.debug(f"permuted logits with shape: {logits.shape}")
+            logging.debug("permuted logits with shape: %s", logits.shape)
 
             sampled_z, selected_probs = sample_from_logits(
                 logits, sample=(
@@ -692,62 +881,31 @@ class VampNet(at.ml.BaseModel):
                 top_k=None, top_p=top_p, return_probs=True,
             )
 
-            logging.debug(f"sampled z with shape: {sampled_z.shape}")
-
-            # flatten z_masked and mask, so we can deal with the sampling logic
-            # we'll unflatten them at the end of the loop for the next forward pass
-            # remove conditioning codebooks, we'll add them back at the end
-            z_masked = codebook_flatten(z_masked[:, self.n_conditioning_codebooks:, :])           
-
-            mask = (z_masked == self.mask_token).int()
-            
-            # update the mask, remove conditioning codebooks from the mask
-            logging.debug(f"updated mask with shape: {mask.shape}")
-            # add z back into sampled z where the mask was false
-            sampled_z = torch.where(
-                mask.bool(), sampled_z, z_masked
-            )
-            logging.debug(f"added z back into sampled z with shape: {sampled_z.shape}")
-
-            # ignore any tokens that weren't masked
-            selected_probs = torch.where(
-                mask.bool(), selected_probs, torch.inf
-            )
-
-            # get the num tokens to mask, according to the schedule
-            num_to_mask = torch.floor(_gamma(r) * num_mask_tokens_at_start).unsqueeze(1).long()
-            logging.debug(f"num to mask: {num_to_mask}")
-
-            if i != (sampling_steps - 1):
-                num_to_mask = torch.maximum(
-                    torch.tensor(1),
-                    torch.minimum(
-                        mask.sum(dim=-1, keepdim=True) - 1,
-                        num_to_mask
-                    )
-                )
-
-
-            # get our new mask
-            mask = mask_by_random_topk(
-                num_to_mask, selected_probs, mask_temperature * (1-r)
-            )  
+            logging.debug("sampled z with shape: %s", sampled_z.shape)
 
-            # update the mask
-            z_masked = torch.where(
-                mask.bool(), self.mask_token, sampled_z
+            # keep the tokens we already had, and pick which ones to mask again
+            remask(
+                sampled_z, selected_probs, z_flat, gamma_sched[i],
+                num_mask_tokens_at_start, mask_token, mask_temperature_sched[i],
+                last_step=(i == sampling_steps - 1),
             )
-            logging.debug(f"updated z_masked with shape: {z_masked.shape}")
-
-            z_masked = codebook_unflatten(z_masked, n_infer_codebooks)
-            mask = codebook_unflatten(mask, n_infer_codebooks)
-            logging.debug(f"unflattened z_masked with shape: {z_masked.shape}")
-
-            # add conditioning codebooks back to z_masked
-            z_masked = torch.cat(
-                (z[:, :self.n_conditioning_codebooks, :], z_masked), dim=1
+            logging.debug("updated z_flat with shape: %s", z_flat.shape)
+
+            # embed the inferred codebooks for the next forward pass,
+            # and the (unmasked) conditioning codebooks after the first step
+            if i == 0:
+                # (the bias goes in here so it's only added once)
+                if n_cond > 0:
+                    x_cond = self.embedding.embed_codes(z[:, :n_cond, :], cond_table)
+                else:
+                    x_cond = self.embedding.out_proj.bias.view(1, 1, -1)
+            torch.add(
+                x_cond,
+                self.embedding.embed_codes(
+                    codebook_unflatten(z_flat, n_infer_codebooks), infer_table, bias=False
+                ),
+                out=x,
             )
-            logging.debug(f"added conditioning codebooks back to z_masked with shape: {z_masked.shape}")
 
 
         # add conditioning codebooks back to sampled_z
@@ -756,13 +914,78 @@ class VampNet(at.ml.BaseModel):
             (z[:, :self.n_conditioning_codebooks, :], sampled_z), dim=1
         )
 
-        logging.debug(f"finished sampling")
+        logging.debug("finished sampling")
 
         if return_signal:
             return self.to_signal(sampled_z, codec)
         else:
             return sampled_z
 
+def _remask(
+        sampled_z: torch.Tensor,
+        selected_probs: torch.Tensor,
+        z_flat: torch.Tensor,
+        gamma_r: torch.Tensor,
+        num_mask_tokens_at_start: torch.Tensor,
+        mask_token: torch.Tensor,
+        temperature: torch.Tensor,
+        last_step: bool = False,
+    ):
+    """
+    one step of the remasking schedule, on the flattened (b, n_infer * t) tokens.
+    `gamma_r` is the schedule _gamma(r) and `temperature` the mask temperature
+    for this step, and `num_mask_tokens_at_start` the number of mask tokens
+    each example started with, all of shape (b,).
+    fills the unmasked positions of `sampled_z` back in from `z_flat`, then
+    writes the next step's tokens (with the least confident ones masked again)
+    into `z_flat`. all updates are in place.
+    """
+    # the mask over the (flat) codebooks we're inferring
+    mask = z_flat == mask_token
+    logging.debug("updated mask with shape: %s", mask.shape)
+
+    # add z back into sampled z where the mask was false
+    torch.where(mask, sampled_z, z_flat, out=sampled_z)
+    logging.debug("added z back into sampled z with shape: %s", sampled_z.shape)
+
+    # ignore any tokens that weren't masked
+    selected_probs.masked_fill_(~mask, torch.inf)
+
+    # get the num tokens to mask, according to the schedule
+    num_to_mask = torch.floor(gamma_r * num_mask_tokens_at_start).unsqueeze(1).long()
+    logging.debug("num to mask: %s", num_to_mask)
+
+    if not last_step:
+        num_to_mask = torch.clamp(
+            torch.minimum(
+                mask.sum(dim=-1, keepdim=True) - 1,
+                num_to_mask
+            ),
+            min=1,
+        )
+
+    # get our new mask
+    mask = mask_by_random_topk(
+        num_to_mask, selected_probs, temperature
+    )
+
+    # update the mask
+    torch.where(mask, mask_token, sampled_z, out=z_flat)
+
+
+# compiled forward passes, per model (see VampNet._get_compiled_forward)
+_compiled_forwards = weakref.WeakKeyDictionary()
+
+_compiled_remask = None
+
+
+def _get_compiled_remask():
+    global _compiled_remask
+    if _compiled_remask is None:
+        _compiled_remask = torch.compile(_remask, dynamic=False)
+    return _compiled_remask
+
+
 def sample_from_logits(
         logits, 
         sample: bool = True,
@@ -801,7 +1024,7 @@ def sample_from_logits(
     shp = logits.shape[:-1]
 
     if typical_filtering:
-        typical_filter(logits, 
+        logits = typical_filter(logits,
                         typical_mass=typical_mass, 
                         typical_min_tokens=typical_min_tokens
         )
@@ -813,8 +1036,7 @@ def sample_from_logits(
 
     # Apply top_p (nucleus) sampling
     if top_p is not None and top_p < 1.0:
-        v, sorted_indices = logits.sort(descending=True)
-        cumulative_probs = v.softmax(dim=-1).cumsum(dim=-1)
+        v, sorted_indices, cumulative_probs = _top_p_candidates(logits, top_p)
 
         sorted_indices_to_remove = cumulative_probs > top_p
         # Right shift indices_to_remove to keep 1st token over threshold
@@ -823,11 +1045,12 @@ def sample_from_logits(
         ]
 
         # Compute indices_to_remove in unsorted array
-        indices_to_remove = sorted_indices_to_remove.scatter(
+        # (anything that didn't make it into the candidates is removed)
+        indices_to_remove = torch.ones_like(logits, dtype=torch.bool).scatter(
             -1, sorted_indices, sorted_indices_to_remove
         )
 
-        logits[indices_to_remove] = -float("inf")
+        logits.masked_fill_(indices_to_remove, -float("inf"))
 
     # Perform multinomial sampling after normalizing logits
     probs = (
@@ -849,6 +1072,25 @@ def sample_from_logits(
     
 
 
+def _top_p_candidates(logits, top_p: float, k: int = 256):
+    """
+    the nucleus usually holds far fewer than vocab_size tokens, so instead
+    of sorting the whole vocab we take the top k logits and double k
+    until every row's top k holds more than top_p of the probability mass.
+    returns the sorted logits, their indices and their cumulative probs.
+    """
+    vocab_size = logits.shape[-1]
+    k = min(k, vocab_size)
+    # normalize against the full vocab, not just the candidates
+    lse = logits.logsumexp(dim=-1, keepdim=True)
+    while True:
+        v, sorted_indices = logits.topk(k, dim=-1)
+        cumulative_probs = (v - lse).exp().cumsum(dim=-1)
+        if k == vocab_size or bool((cumulative_probs[..., -1] > top_p).all()):
+            return v, sorted_indices, cumulative_probs
+        k = min(k * 2, vocab_size)
+
+
 def mask_by_random_topk(
         num_to_mask: int, 
         probs: torch.Tensor, 
@@ -858,31 +1100,37 @@ def mask_by_random_topk(
     Args:
         num_to_mask (int): number of tokens to mask
         probs (torch.Tensor): probabilities for each sampled event, shape (batch, seq)
-        temperature (float, optional): temperature. Defaults to 1.0.
+        temperature (float or torch.Tensor, optional): temperature, either a scalar
+            or one per batch item, shape (batch,). Defaults to 1.0.
     """
-    logging.debug(f"masking by random topk")
-    logging.debug(f"num to mask: {num_to_mask}")
-    logging.debug(f"probs shape: {probs.shape}")
-    logging.debug(f"temperature: {temperature}")
+    logging.debug("masking by random topk")
+    logging.debug("num to mask: %s", num_to_mask)
+    logging.debug("probs shape: %s", probs.shape)
+    logging.debug("temperature: %s", temperature)
     logging.debug("")
 
-    noise = gumbel_noise_like(probs)
-    confidence = torch.log(probs) + temperature * noise
-    logging.debug(f"confidence shape: {confidence.shape}")
+    if torch.is_tensor(temperature) and temperature.ndim == 1:
+        # one temperature per batch item, broadcast over the sequence
+        temperature = temperature.unsqueeze(-1)
+
+    # log(probs) + temperature * noise, built in place on the noise buffer
+    confidence = gumbel_noise_like(probs).mul_(temperature).add_(probs.log())
+    logging.debug("confidence shape: %s", confidence.shape)
 
-    sorted_confidence, sorted_idx = confidence.sort(dim=-1)
-    logging.debug(f"sorted confidence shape: {sorted_confidence.shape}")
-    logging.debug(f"sorted idx shape: {sorted_idx.shape}")
+    # num_to_mask differs per row, so a topk/kthvalue would need a host sync to
+    # pick k. a sort along the sequence keeps this on the device.
+    sorted_confidence, _ = confidence.sort(dim=-1)
+    logging.debug("sorted confidence shape: %s", sorted_confidence.shape)
 
     # get the cut off threshold, given the mask length
     cut_off = torch.take_along_dim(
         sorted_confidence, num_to_mask, axis=-1
     )
-    logging.debug(f"cut off shape: {cut_off.shape}")
+    logging.debug("cut off shape: %s", cut_off.shape)
 
     # mask out the tokens
     mask = confidence < cut_off
-    logging.debug(f"mask shape: {mask.shape}")
+    logging.debug("mask shape: %s", mask.shape)
 
     return mask
 
@@ -897,20 +1145,28 @@ def typical_filter(
     entropy = -(x_flat_norm * x_flat_norm_p).nansum(-1, keepdim=True)
 
     c_flat_shifted = torch.abs((-x_flat_norm) - entropy)
-    c_flat_sorted, x_flat_indices = torch.sort(c_flat_shifted, descending=False)
-    x_flat_cumsum = (
-        x_flat.gather(-1, x_flat_indices).softmax(dim=-1).cumsum(dim=-1)
-    )
 
-    last_ind = (x_flat_cumsum < typical_mass).sum(dim=-1)
-    sorted_indices_to_remove = c_flat_sorted > c_flat_sorted.gather(
+    # the typical set is usually a small part of the vocab, so instead of
+    # sorting all of it we take the k most typical tokens, doubling k until
+    # they hold at least typical_mass of the probability in every row.
+    vocab_size = x_flat.shape[-1]
+    k = min(max(typical_min_tokens, 256), vocab_size)
+    while True:
+        c_flat_sorted, x_flat_indices = torch.topk(
+            c_flat_shifted, k, dim=-1, largest=False
+        )
+        x_flat_cumsum = x_flat_norm_p.gather(-1, x_flat_indices).cumsum(dim=-1)
+        if k == vocab_size or bool((x_flat_cumsum[:, -1] >= typical_mass).all()):
+            break
+        k = min(k * 2, vocab_size)
+
+    last_ind = (x_flat_cumsum < typical_mass).sum(dim=-1).clamp(max=k - 1)
+    # anything less typical than the cutoff token is removed
+    indices_to_remove = c_flat_shifted > c_flat_sorted.gather(
         1, last_ind.view(-1, 1)
     )
     if typical_min_tokens > 1:
-        sorted_indices_to_remove[..., :typical_min_tokens] = 0
-    indices_to_remove = sorted_indices_to_remove.scatter(
-        1, x_flat_indices, sorted_indices_to_remove
-    )
+        indices_to_remove.scatter_(1, x_flat_indices[:, :typical_min_tokens], False)
     x_flat = x_flat.masked_fill(indices_to_remove, -float("Inf"))
     logits = rearrange(x_flat, "(b t) l -> b t l", t=nt)
     return logits
@@ -1,12 +1,36 @@
 import tqdm
 
 import torch
-from einops import rearrange
+from audiotools import AudioSignal
+from audiotools.core.util import flatten, unflatten
 
 def scalar_to_batch_tensor(x, batch_size):
     return torch.tensor(x).repeat(batch_size)
 
 
+def prepare_batch(batch, device: str = "cpu", non_blocking: bool = True):
+    """
+    like audiotools.util.prepare_batch, but issues non-blocking copies,
+    so that host->device copies of pinned batches can overlap with compute.
+    """
+    if isinstance(batch, dict):
+        batch = flatten(batch)
+        for key, val in batch.items():
+            batch[key] = prepare_batch(val, device, non_blocking)
+        batch = unflatten(batch)
+    elif isinstance(batch, list):
+        batch = [prepare_batch(val, device, non_blocking) for val in batch]
+    elif isinstance(batch, AudioSignal):
+        batch.audio_data = batch.audio_data.to(device, non_blocking=non_blocking)
+        if batch._loudness is not None:
+            batch._loudness = batch._loudness.to(device, non_blocking=non_blocking)
+        if batch.stft_data is not None:
+            batch.stft_data = batch.stft_data.to(device, non_blocking=non_blocking)
+    elif torch.is_tensor(batch):
+        batch = batch.to(device, non_blocking=non_blocking)
+    return batch
+
+
 def parallelize(
         fn, 
         *iterables,
@@ -36,11 +60,13 @@ def codebook_flatten(tokens: torch.Tensor):
     """ 
     flatten a sequence of tokens from (batch, codebook, time) to (batch, codebook * time)
     """
-    return rearrange(tokens, "b c t -> b (t c)")
+    # same as rearrange(tokens, "b c t -> b (t c)"), without parsing the pattern.
+    # the reshape copies the transposed view, so the result is always contiguous
+    return tokens.transpose(1, 2).reshape(tokens.shape[0], -1)
 
 def codebook_unflatten(flat_tokens: torch.Tensor, n_c: int = None):
     """
     unflatten a sequence of tokens from (batch, codebook * time) to (batch, codebook, time)
     """
-    tokens = rearrange(flat_tokens, "b (t c) -> b c t", c=n_c)
+    tokens = flat_tokens.reshape(flat_tokens.shape[0], -1, n_c).transpose(1, 2)
     return tokens